@@ -31,6 +31,10 @@ INTERPOLATION = 'bspline'
 CHUNK_THRESHOLD_RESAMPLING = 150
 CHUNK_THRESHOLD_INFERRING = 350
 
+# INFERENCE PARAMETERS
+TILE_STEP_SIZE = 0.5
+USE_MIRRORING = True
+
 # POSTPROCESSING PARAMETERS
 TUMOR_LABEL = 12
 
@@ -51,6 +55,9 @@ DEFAULT_SPACING = (1.5, 1.5, 1.5)
 FILE_NAME_DATASET_JSON = "dataset.json"
 FILE_NAME_PLANS_JSON = "plans.json"
 
+# DOWNLOAD PARAMETERS
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 ENHANCE_URL = "https://enhance-pet.s3.eu-central-1.amazonaws.com/enhance-pet-1_6k/ENHANCE-PET-1_6k.zip"
 
@@ -91,6 +98,10 @@ This module contains the following constants:
 - `INTERPOLATION`: A constant that stores the interpolation method used by the moosez algorithm.
 - `CHUNK_THRESHOLD`: A constant that stores the chunk threshold used by the moosez algorithm.
 
+- `TILE_STEP_SIZE`: A constant that stores the sliding window step size (relative to the patch size) used for inference.
+- `USE_MIRRORING`: A constant that determines if test time mirroring is used for inference. Models trained without
+  mirroring have no mirroring axes, so for them this has no effect.
+
 - `TUMOR_LABEL`: A constant that stores the label used for tumors by the moosez algorithm.
 
 - `MIP_ROTATION_STEP`: A constant that stores the MIP rotation step used by the moosez algorithm.
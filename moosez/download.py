@@ -1,7 +1,6 @@
 
 import os
 from pathlib import Path
-import requests
 from typing import Union
 from moosez import constants
 from moosez import system
@@ -16,21 +15,23 @@ def download_enhance_data(download_directory: Union[str, None], output_manager:
     download_file_name = os.path.basename(constants.ENHANCE_URL)
     download_file_path = os.path.join(download_directory, download_file_name)
 
+    # Imported here, as it is only needed when the data is downloaded
+    import requests
+
     response = requests.get(constants.ENHANCE_URL, stream=True)
     if response.status_code != 200:
         output_manager.console_update(f"    X Failed to download model from {constants.ENHANCE_URL}")
         raise Exception(f"Failed to download model from {constants.ENHANCE_URL}")
     total_size = int(response.headers.get("Content-Length", 0))
-    chunk_size = 1024 * 10
 
     progress = output_manager.create_file_progress_bar()
     with progress:
         task = progress.add_task(f"[white] Downloading ENHANCE 1.6k data...", total=total_size)
         with open(download_file_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=chunk_size):
+            for chunk in response.iter_content(chunk_size=constants.DOWNLOAD_CHUNK_SIZE):
                 if chunk:
                     f.write(chunk)
-                    progress.update(task, advance=chunk_size)
+                    progress.update(task, advance=len(chunk))
     output_manager.console_update(f"{constants.ANSI_GREEN} ENHANCE 1.6k data successfuly downloaded. {constants.ANSI_RESET}")
 
 
@@ -20,7 +20,7 @@ import glob
 import os
 import shutil
 from datetime import datetime
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Tuple, List
 from moosez import constants
 
@@ -59,10 +59,8 @@ def get_files(directory: str, prefix: Union[str, Tuple[str, ...]], suffix: Union
     if isinstance(suffix, str):
         suffix = (suffix,)
 
-    files = []
-    for file in os.listdir(directory):
-        if file.startswith(prefix) and file.endswith(suffix):
-            files.append(os.path.join(directory, file))
+    with os.scandir(directory) as entries:
+        files = [entry.path for entry in entries if entry.name.startswith(prefix) and entry.name.endswith(suffix)]
     return files
 
 
@@ -102,6 +100,7 @@ def copy_file(file: str, destination: str) -> None:
 def copy_files_to_destination(files: List[str], destination: str) -> None:
     """
     Copies the files inside the list to the destination directory in a parallel fashion.
+    Copying is I/O bound, so threads are used instead of spawning one process per file.
     
     :param files: The list of files to be copied.
     :type files: list
@@ -109,8 +108,11 @@ def copy_files_to_destination(files: List[str], destination: str) -> None:
     :param destination: The path to the destination directory.
     :type destination: str
     """
-    with Pool(processes=len(files)) as pool:
-        pool.starmap(copy_file, [(file, destination) for file in files])
+    if not files:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(32, len(files))) as executor:
+        list(executor.map(copy_file, files, [destination] * len(files)))
 
 
 def select_files_by_modality(moose_compliant_subjects: List[str], modality_tag: str) -> List:
@@ -128,10 +130,9 @@ def select_files_by_modality(moose_compliant_subjects: List[str], modality_tag:
     """
     selected_files = []
     for subject in moose_compliant_subjects:
-        files = os.listdir(subject)
-        for file in files:
-            if file.startswith(modality_tag) and (file.endswith('.nii') or file.endswith('.nii.gz')):
-                selected_files.append(os.path.join(subject, file))
+        with os.scandir(subject) as entries:
+            selected_files.extend(entry.path for entry in entries
+                                  if entry.name.startswith(modality_tag) and entry.name.endswith(('.nii', '.nii.gz')))
     return selected_files
 
 
@@ -17,8 +17,7 @@
 #
 # ----------------------------------------------------------------------------------------------------------------------
 
-import contextlib
-import io
+import logging
 import os
 import re
 import shutil
@@ -28,10 +27,15 @@ import dicom2nifti
 import pydicom
 import multiprocessing as mp
 import concurrent.futures
-from typing import Union, Dict
+from typing import Union, Dict, List
 from moosez import system
 
 
+# Patterns used to clean the DICOM derived file names, compiled once instead of on every DICOM file
+SPECIAL_CHARACTERS_PATTERN = re.compile(r'[^\w\s-]')
+SEPARATORS_PATTERN = re.compile(r'[-\s]+')
+
+
 def non_nifti_to_nifti(input_path: str, output_directory: Union[str, None] = None) -> None:
     """
     Converts any image format known to ITK to NIFTI
@@ -82,18 +86,25 @@ def non_nifti_to_nifti(input_path: str, output_directory: Union[str, None] = Non
     SimpleITK.WriteImage(output_image, output_image_path)
 
 
-def standardize_subject(parent_dir: str, subject: str):
-    subject_path = os.path.join(parent_dir, subject)
-    if os.path.isdir(subject_path):
-        images = os.listdir(subject_path)
-        for image in images:
-            image_path = os.path.join(subject_path, image)
-            path_is_valid = os.path.isdir(image_path) or os.path.isfile(image_path)
-            path_is_valid = path_is_valid and ("moosez" not in os.path.basename(image_path))
-            if path_is_valid:
-                non_nifti_to_nifti(image_path)
-    else:
-        return
+def get_convertible_paths(subject_path: str) -> List[str]:
+    """
+    Returns the directories and non-NIfTI files of a subject that need to be converted to NIfTI.
+
+    :param subject_path: The path to the subject directory.
+    :type subject_path: str
+    :return: The list of paths to convert.
+    :rtype: list
+    """
+    convertible_paths = []
+    with os.scandir(subject_path) as entries:
+        for entry in entries:
+            if "moosez" in entry.name:
+                continue
+            if entry.is_file() and (entry.name.startswith('.') or entry.name.endswith(('.nii.gz', '.nii'))):
+                continue
+            if entry.is_dir() or entry.is_file():
+                convertible_paths.append(entry.path)
+    return convertible_paths
 
 
 def standardize_to_nifti(parent_dir: str, output_manager: system.OutputManager) -> None:
@@ -107,24 +118,34 @@ def standardize_to_nifti(parent_dir: str, output_manager: system.OutputManager)
     :return: None
     """
     # Get a list of all subdirectories in the parent directory
-    subjects = os.listdir(parent_dir)
-    subjects = [subject for subject in subjects if os.path.isdir(os.path.join(parent_dir, subject))]
+    with os.scandir(parent_dir) as entries:
+        subject_paths = [entry.path for entry in entries if entry.is_dir()]
+
+    # Collect the images of all subjects that are not NIfTI yet, so the work is balanced per image and not per subject
+    convertible_paths = []
+    for subject_path in subject_paths:
+        convertible_paths.extend(get_convertible_paths(subject_path))
+
+    output_manager.log_update(f"Number of images to convert: {len(convertible_paths)}")
+    if not convertible_paths:
+        return
 
     # Convert all non-NIfTI images in each subdirectory to NIfTI format
     progress = output_manager.create_progress_bar()
     with progress:
-        task = progress.add_task("[white] Processing subjects...", total=len(subjects))
+        task = progress.add_task("[white] Processing images...", total=len(convertible_paths))
 
         mp_context = mp.get_context('spawn')
         max_workers = mp.cpu_count()//4 if mp.cpu_count() > 4 else 1
         max_workers = max_workers if max_workers <= 32 else 32
         output_manager.log_update(f"Number of workers: {max_workers}")
         with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
-            futures = []
-            for subject in subjects:
-                futures.append(executor.submit(standardize_subject, parent_dir, subject))
+            futures = {}
+            for convertible_path in convertible_paths:
+                futures[executor.submit(non_nifti_to_nifti, convertible_path)] = convertible_path
 
-            for _ in concurrent.futures.as_completed(futures):
+            for future in concurrent.futures.as_completed(futures):
+                subject = os.path.basename(os.path.dirname(futures[future]))
                 progress.update(task, advance=1, description=f"[white] Processing {subject}...")
 
 
@@ -139,9 +160,13 @@ def dcm2niix(input_path: str) -> str:
     """
     output_dir = os.path.dirname(input_path)
 
-    # Redirect standard output and standard error to discard output
-    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
-        dicom2nifti.convert_directory(input_path, output_dir, compression=False, reorient=True)
+    # dicom2nifti reports through logging, so discard its records instead of redirecting the process streams
+    dicom2nifti_logger = logging.getLogger('dicom2nifti')
+    if not dicom2nifti_logger.handlers:
+        dicom2nifti_logger.addHandler(logging.NullHandler())
+    dicom2nifti_logger.propagate = False
+
+    dicom2nifti.convert_directory(input_path, output_dir, compression=False, reorient=True)
 
     return output_dir
 
@@ -158,8 +183,8 @@ def remove_accents(unicode_filename: str) -> str:
     try:
         unicode_filename = str(unicode_filename).replace(" ", "_")
         cleaned_filename = unicodedata.normalize('NFKD', unicode_filename).encode('ASCII', 'ignore').decode('ASCII')
-        cleaned_filename = re.sub(r'[^\w\s-]', '', cleaned_filename.strip().lower())
-        cleaned_filename = re.sub(r'[-\s]+', '-', cleaned_filename)
+        cleaned_filename = SPECIAL_CHARACTERS_PATTERN.sub('', cleaned_filename.strip().lower())
+        cleaned_filename = SEPARATORS_PATTERN.sub('-', cleaned_filename)
         return cleaned_filename
     except:
         return unicode_filename
@@ -31,6 +31,32 @@ from moosez import models
 from moosez import system
 
 
+INTERPOLATION_METHODS = {
+    'nearest': SimpleITK.sitkNearestNeighbor,
+    'linear': SimpleITK.sitkLinear,
+    'bspline': SimpleITK.sitkBSpline
+}
+
+# Flips the x and y axes between the nibabel (RAS) and SimpleITK (LPS) world coordinates
+RAS_TO_LPS_FLIP = np.diag([-1, -1, 1])
+RAS_TO_LPS_FLIP.setflags(write=False)
+
+
+def get_regions_present(labels_present: List[int], model: models.Model) -> List[str]:
+    """
+    Maps the label intensities present in a segmentation to the region names of the model.
+
+    :param labels_present: The label intensities present in the segmentation.
+    :type labels_present: list
+    :param model: The model.
+    :type model: Model
+    :return: The region names of the labels known to the model.
+    :rtype: list
+    """
+    organ_indices = model.organ_indices
+    return [organ_indices[label] for label in labels_present if label in organ_indices]
+
+
 def get_intensity_statistics(image: SimpleITK.Image, mask_image: SimpleITK.Image, model: models.Model, out_csv: str) -> None:
     """
     Get the intensity statistics of a NIFTI image file.
@@ -56,14 +82,7 @@ def get_intensity_statistics(image: SimpleITK.Image, mask_image: SimpleITK.Image
                    intensity_statistics.GetMinimum(i)) for i in intensity_statistics.GetLabels()]
     columns = ['Mean', 'Standard-Deviation', 'Median', 'Maximum', 'Minimum']
     stats_df = pd.DataFrame(data=stats_list, index=intensity_statistics.GetLabels(), columns=columns)
-    labels_present = stats_df.index.to_list()
-    regions_present = []
-    organ_indices_dict = model.organ_indices
-    for label in labels_present:
-        if label in organ_indices_dict:
-            regions_present.append(organ_indices_dict[label])
-        else:
-            continue
+    regions_present = get_regions_present(stats_df.index.to_list(), model)
     stats_df.insert(0, 'Regions-Present', np.array(regions_present))
     stats_df.to_csv(out_csv)
 
@@ -89,14 +108,7 @@ def get_shape_statistics(mask_image: SimpleITK.Image, model: models.Model, out_c
     stats_df = pd.DataFrame(data=stats_list, index=[i for i in label_shape_filter.GetLabels() if i != 0],
                             columns=columns)
 
-    labels_present = stats_df.index.to_list()
-    regions_present = []
-    organ_indices_dict = model.organ_indices
-    for label in labels_present:
-        if label in organ_indices_dict:
-            regions_present.append(organ_indices_dict[label])
-        else:
-            continue
+    regions_present = get_regions_present(stats_df.index.to_list(), model)
     stats_df.insert(0, 'Regions-Present', np.array(regions_present))
     stats_df.to_csv(out_csv)
 
@@ -107,10 +119,14 @@ def limit_fov(image_array: np.array, segmentation_array: np.array, fov_label: Un
         segmentation_array = largest_connected_component(segmentation_array, fov_label)
 
     if isinstance(fov_label, list):
-        z_indices = np.where((segmentation_array >= fov_label[0]) & (segmentation_array <= fov_label[1]))[0]
+        fov_mask = (segmentation_array >= fov_label[0]) & (segmentation_array <= fov_label[1])
     else:
-        z_indices = np.where(segmentation_array == fov_label)[0]
-    z_min, z_max = np.min(z_indices), np.max(z_indices)
+        fov_mask = segmentation_array == fov_label
+    # Only the z extent is needed, so reduce each slice to one flag instead of collecting every voxel coordinate
+    z_indices = np.flatnonzero(fov_mask.any(axis=(1, 2)))
+    if z_indices.size == 0:
+        raise ValueError(f'The label(s) {fov_label} to limit the field of view to are not in the segmentation.')
+    z_min, z_max = z_indices[0], z_indices[-1]
 
     # Crop the CT data along the z-axis
     limited_fov_array = image_array[z_min:z_max + 1, :, :]
@@ -399,13 +415,9 @@ class ImageResampler:
     def resample_image_SimpleITK_DASK_array(sitk_image: SimpleITK.Image, interpolation: str,
                                             output_spacing: Tuple[float, float, float] = (1.5, 1.5, 1.5),
                                             output_size: Union[Tuple[float, float, float], None] = None) -> np.array:
-        if interpolation == 'nearest':
-            interpolation_method = SimpleITK.sitkNearestNeighbor
-        elif interpolation == 'linear':
-            interpolation_method = SimpleITK.sitkLinear
-        elif interpolation == 'bspline':
-            interpolation_method = SimpleITK.sitkBSpline
-        else:
+        try:
+            interpolation_method = INTERPOLATION_METHODS[interpolation]
+        except KeyError:
             raise ValueError('The interpolation method is not supported.')
 
         input_spacing = sitk_image.GetSpacing()
@@ -444,7 +456,6 @@ def determine_orientation_code(image: nibabel.Nifti1Image) -> Tuple[Union[Tuple,
 
 
 def confirm_orthonormality(image: nibabel.Nifti1Image) -> Tuple[nibabel.Nifti1Image, bool]:
-    data = image.get_fdata()
     affine = image.affine
     header = image.header
 
@@ -467,7 +478,8 @@ def confirm_orthonormality(image: nibabel.Nifti1Image) -> Tuple[nibabel.Nifti1Im
         orthonormal_header.set_qform(orthonormal_affine)
         orthonormal_header.set_sform(orthonormal_affine)
 
-        image = nibabel.Nifti1Image(data, orthonormal_affine, orthonormal_header)
+        # Only the affine changes, so the voxel data is passed on lazily without being read
+        image = nibabel.Nifti1Image(image.dataobj, orthonormal_affine, orthonormal_header)
     else:
         orthonormalized = False
 
@@ -475,7 +487,6 @@ def confirm_orthonormality(image: nibabel.Nifti1Image) -> Tuple[nibabel.Nifti1Im
 
 
 def confirm_orientation(image: nibabel.Nifti1Image) -> Tuple[nibabel.Nifti1Image, bool]:
-    data = image.get_fdata()
     affine = image.affine
     header = image.header
 
@@ -483,6 +494,7 @@ def confirm_orientation(image: nibabel.Nifti1Image) -> Tuple[nibabel.Nifti1Image
 
     if original_orientation[0] == 'R':
         reoriented = True
+        data = image.get_fdata()
 
         current_orientation = nibabel.orientations.axcodes2ornt(original_orientation)
         target_orientation = nibabel.orientations.axcodes2ornt(('L', original_orientation[1], original_orientation[2]))
@@ -512,38 +524,70 @@ def convert_to_sitk(image: nibabel.Nifti1Image) -> SimpleITK.Image:
 
     translation_vector = affine[:3, 3]
     rotation_matrix = affine[:3, :3]
-    axis_flip_matrix = np.diag([-1, -1, 1])
 
     sitk_image.SetSpacing([spacing.item() for spacing in spacing])
-    sitk_image.SetOrigin(np.dot(axis_flip_matrix, translation_vector))
-    sitk_image.SetDirection((np.dot(axis_flip_matrix, rotation_matrix) / np.absolute(spacing)).flatten())
+    sitk_image.SetOrigin(np.dot(RAS_TO_LPS_FLIP, translation_vector))
+    sitk_image.SetDirection((np.dot(RAS_TO_LPS_FLIP, rotation_matrix) / np.absolute(spacing)).flatten())
 
     return sitk_image
 
 
-def standardize_image(image_path: str, output_manager: system.OutputManager, standardization_output_path: Union[str, None]) -> SimpleITK.Image:
+def standardize_image(image_path: str, output_manager: system.OutputManager, subject_name: str) -> Tuple[SimpleITK.Image, str]:
+    """
+    Loads an image, orthonormalizes and reorients it if needed and converts it to SimpleITK.
+    The subject is named in every log line, as the image of the next subject can be loaded while another subject is
+    being predicted.
+
+    :param image_path: The path to the NIfTI image.
+    :type image_path: str
+    :param output_manager: The output manager for console and logging.
+    :type output_manager: system.OutputManager
+    :param subject_name: The name of the subject the image belongs to.
+    :type subject_name: str
+    :return: The standardized image and the prefix for writing it, empty if the image was not changed.
+    :rtype: Tuple[SimpleITK.Image, str]
+    """
     image = nibabel.load(image_path)
     _, original_orientation = determine_orientation_code(image)
-    output_manager.log_update(f" - Image loaded. Orientation: {original_orientation}")
+    output_manager.log_update(f" - Image of {subject_name} loaded. Orientation: {original_orientation}")
 
     image, orthonormalized = confirm_orthonormality(image)
     if orthonormalized:
         _, orthonormal_orientation = determine_orientation_code(image)
-        output_manager.log_update(f"   - Image orthonormalized. Orientation: {orthonormal_orientation}")
+        output_manager.log_update(f"   - Image of {subject_name} orthonormalized. Orientation: {orthonormal_orientation}")
     image, reoriented = confirm_orientation(image)
     if reoriented:
         _, reoriented_orientation = determine_orientation_code(image)
-        output_manager.log_update(f"   - Image reoriented. Orientation: {reoriented_orientation}")
+        output_manager.log_update(f"   - Image of {subject_name} reoriented. Orientation: {reoriented_orientation}")
     sitk_image = convert_to_sitk(image)
-    output_manager.log_update(f" - Image converted to SimpleITK.")
+    output_manager.log_update(f" - Image of {subject_name} converted to SimpleITK.")
 
     processing_steps = [orthonormalized, reoriented]
     prefixes = ["orthonormal", "reoriented"]
+    standardization_prefix = "_".join([prefix for processing_step, prefix in zip(processing_steps, prefixes) if processing_step])
+
+    return sitk_image, standardization_prefix
+
 
-    if standardization_output_path is not None and any(processing_steps):
-        output_manager.log_update(f" - Writing standardized image.")
-        prefix = "_".join([prefix for processing_step, prefix in zip(processing_steps, prefixes) if processing_step])
-        output_path = os.path.join(standardization_output_path, f"{prefix}_{os.path.basename(image_path)}")
-        SimpleITK.WriteImage(sitk_image, output_path)
+def write_standardized_image(sitk_image: SimpleITK.Image, image_path: str, standardization_prefix: str,
+                             standardization_output_path: str, output_manager: system.OutputManager) -> None:
+    """
+    Writes the standardized image next to the results, if standardizing changed the image.
+
+    :param sitk_image: The standardized image.
+    :type sitk_image: SimpleITK.Image
+    :param image_path: The path to the original image.
+    :type image_path: str
+    :param standardization_prefix: The prefix returned by standardize_image, empty if the image was not changed.
+    :type standardization_prefix: str
+    :param standardization_output_path: The directory to write the standardized image to.
+    :type standardization_output_path: str
+    :param output_manager: The output manager for console and logging.
+    :type output_manager: system.OutputManager
+    """
+    if not standardization_prefix:
+        return
 
-    return sitk_image
\ No newline at end of file
+    output_manager.log_update(f" - Writing standardized image.")
+    output_path = os.path.join(standardization_output_path, f"{standardization_prefix}_{os.path.basename(image_path)}")
+    SimpleITK.WriteImage(sitk_image, output_path)
@@ -95,9 +95,9 @@ def select_moose_compliant_subjects(subject_paths: List[str], modality_tags: Lis
     for subject_path in subject_paths:
         # go through each subject and see if the files have the appropriate modality prefixes
 
-        files = [file for file in os.listdir(subject_path) if file.endswith('.nii') or file.endswith('.nii.gz')]
-        prefixes = [file.startswith(tag) for tag in modality_tags for file in files]
-        if sum(prefixes) == len(modality_tags):
+        files = [file for file in os.listdir(subject_path) if file.endswith(('.nii', '.nii.gz'))]
+        matches = sum(file.startswith(tag) for tag in modality_tags for file in files)
+        if matches == len(modality_tags):
             moose_compliant_subjects.append(subject_path)
     output_manager.console_update(f"{constants.ANSI_ORANGE} Number of moose compliant subjects: {len(moose_compliant_subjects)} out of {len(subject_paths)} {constants.ANSI_RESET}")
     output_manager.log_update(f" Number of moose compliant subjects: {len(moose_compliant_subjects)} out of {len(subject_paths)}")
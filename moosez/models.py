@@ -1,15 +1,18 @@
 import os
+import sys
 import json
 import zipfile
-import requests
 import shutil
-from typing import Union, Tuple, List, Dict
+import tempfile
+from collections.abc import Mapping
+from types import MappingProxyType
+from typing import Union, Tuple, List, Dict, Iterable
 from moosez import system
 from moosez.constants import (KEY_FOLDER_NAME, KEY_URL, KEY_LIMIT_FOV, DEFAULT_SPACING, FILE_NAME_DATASET_JSON,
-                              FILE_NAME_PLANS_JSON, ANSI_GREEN, ANSI_RESET)
+                              FILE_NAME_PLANS_JSON, DOWNLOAD_CHUNK_SIZE, ANSI_GREEN, ANSI_RESET)
 
 
-MODEL_METADATA = {
+MODEL_METADATA = MappingProxyType({
     "clin_ct_lungs": {
         KEY_URL: "https://enhance-pet.s3.eu-central-1.amazonaws.com/moose/clin_ct_lungs_24062023.zip",
         KEY_FOLDER_NAME: "Dataset333_HMS3dlungs",
@@ -103,12 +106,12 @@ MODEL_METADATA = {
     "clin_ct_body_composition": {
         KEY_URL: "https://enhance-pet.s3.eu-central-1.amazonaws.com/moose/clin_ct_body_composition_05092024.zip",
         KEY_FOLDER_NAME: "Dataset778_Body_composition",
-        KEY_LIMIT_FOV: {
+        KEY_LIMIT_FOV: MappingProxyType({
             "model_to_crop_from": "clin_ct_fast_vertebrae",
             "inference_fov_intensities": [20, 24],
             "label_intensity_to_crop_from": 22,
             "largest_component_only": True
-        }
+        })
     },
     "clin_ct_fast_vertebrae": {
         KEY_URL: "https://enhance-pet.s3.eu-central-1.amazonaws.com/moose/clin_ct_vertebrae3_10092024.zip",
@@ -130,33 +133,158 @@ MODEL_METADATA = {
         KEY_FOLDER_NAME: "Dataset112_DentalSegmentator_v100",
         KEY_LIMIT_FOV: None
     }
-}
+})
 
-AVAILABLE_MODELS = MODEL_METADATA.keys()
+LIMIT_FOV_KEYS = ("model_to_crop_from", "inference_fov_intensities", "label_intensity_to_crop_from", "largest_component_only")
+
+
+def validate_model_metadata(model_metadata: Mapping) -> None:
+    """
+    Checks that every model metadata entry has the keys the workflows read, so a malformed entry fails at import
+    instead of in the middle of a prediction.
+
+    :param model_metadata: The model metadata, keyed by model identifier.
+    :type model_metadata: Mapping
+    :raises ValueError: If an entry is malformed.
+    """
+    for model_identifier, metadata in model_metadata.items():
+        if len(model_identifier.split('_', 2)) != 3:
+            raise ValueError(f"Model identifier '{model_identifier}' is not of the form imaging_modality_region.")
+
+        missing_keys = [key for key in (KEY_URL, KEY_FOLDER_NAME, KEY_LIMIT_FOV) if key not in metadata]
+        if missing_keys:
+            raise ValueError(f"Model '{model_identifier}' is missing the metadata key(s): {', '.join(missing_keys)}.")
+
+        # None marks models that are not downloadable yet, an empty string is always a mistake
+        if metadata[KEY_URL] == "" or metadata[KEY_FOLDER_NAME] == "":
+            raise ValueError(f"Model '{model_identifier}' has an empty {KEY_URL} or {KEY_FOLDER_NAME}.")
+
+        limit_fov = metadata[KEY_LIMIT_FOV]
+        if limit_fov is None:
+            continue
+        if not isinstance(limit_fov, Mapping):
+            raise ValueError(f"Model '{model_identifier}' has a {KEY_LIMIT_FOV} that is neither None nor a mapping.")
+
+        missing_keys = [key for key in LIMIT_FOV_KEYS if key not in limit_fov]
+        if missing_keys:
+            raise ValueError(f"Model '{model_identifier}' is missing the {KEY_LIMIT_FOV} key(s): {', '.join(missing_keys)}.")
+        if limit_fov["model_to_crop_from"] not in model_metadata:
+            raise ValueError(f"Model '{model_identifier}' crops from the unknown model '{limit_fov['model_to_crop_from']}'.")
+
+
+validate_model_metadata(MODEL_METADATA)
+
+AVAILABLE_MODELS = tuple(MODEL_METADATA)
+
+
+def get_model_metadata(model_identifier: str) -> Mapping:
+    """
+    Returns the metadata of a model. The metadata is validated at import, so a returned entry is complete.
+
+    :param model_identifier: The model identifier, e.g. 'clin_ct_organs'.
+    :type model_identifier: str
+    :return: The url, folder name and limit_fov of the model.
+    :rtype: Mapping
+    :raises ValueError: If the model does not exist.
+    """
+    try:
+        return MODEL_METADATA[model_identifier]
+    except KeyError:
+        raise ValueError(f"Unknown model '{model_identifier}'. Available models: {', '.join(AVAILABLE_MODELS)}") from None
+
+
+def get_model_identifier_segments(model_identifier: str) -> Tuple[str, str, str]:
+    """
+    Splits a model identifier into imaging type, modality and region, e.g. 'clin_ct_organs' into
+    ('clin', 'CT', 'organs') and 'clin_pt_fdg_brain_v1' into ('clin', 'PT_FDG', 'brain_v1').
+    Works on the identifier alone, so no model has to be loaded for it.
+
+    :param model_identifier: The model identifier.
+    :type model_identifier: str
+    :return: The imaging type, modality and region of the model.
+    :rtype: tuple
+    """
+    imaging_type, modality, region = model_identifier.split('_', 2)
+    if modality == 'pt':
+        tracer, _, region = region.partition('_')
+        modality = f'{modality}_{tracer}'
+
+    return imaging_type, modality.upper(), region
+
+
+def get_multilabel_prefix(model_identifier: str) -> str:
+    """
+    Returns the prefix that is put in front of the output files of a model, e.g. 'clin_CT_organs_'.
+
+    :param model_identifier: The model identifier.
+    :type model_identifier: str
+    :return: The multilabel prefix of the model.
+    :rtype: str
+    """
+    imaging_type, modality, region = get_model_identifier_segments(model_identifier)
+    return f"{imaging_type}_{modality}_{region}_"
+
+
+MODEL_DEPENDENCIES = MappingProxyType({model_identifier: metadata[KEY_LIMIT_FOV]["model_to_crop_from"]
+                                        for model_identifier, metadata in MODEL_METADATA.items()
+                                        if metadata[KEY_LIMIT_FOV]})
+
+
+def get_required_models(model_identifiers: Iterable[str]) -> List[str]:
+    """
+    Returns the unique models needed to run the given models, with every model listed after the model it crops from.
+
+    :param model_identifiers: The requested model identifiers.
+    :type model_identifiers: Iterable[str]
+    :return: The required model identifiers in dependency order.
+    :rtype: List[str]
+    """
+    required_models: List[str] = []
+    for model_identifier in model_identifiers:
+        dependency_chain = []
+        while model_identifier is not None and model_identifier not in required_models and model_identifier not in dependency_chain:
+            dependency_chain.append(model_identifier)
+            model_identifier = MODEL_DEPENDENCIES.get(model_identifier)
+        required_models.extend(reversed(dependency_chain))
+    return required_models
 
 
 class Model:
+    # Every model has the same fixed set of attributes, so they are stored in slots instead of a per-instance dict
+    __slots__ = ('model_identifier', 'folder_name', 'url', 'limit_fov', 'directory', 'configuration_folders',
+                 'configuration_directory', 'trainer', 'planner', 'resolution_configuration', 'folds', 'dataset',
+                 'plans', 'voxel_spacing', 'imaging_type', 'modality', 'region', 'multilabel_prefix', 'organ_indices',
+                 'nr_training_data', 'expected_modalities', 'expected_prefixes')
+
     def __init__(self, model_identifier: str, output_manager: system.OutputManager):
         self.model_identifier = model_identifier
-        self.folder_name = MODEL_METADATA[self.model_identifier][KEY_FOLDER_NAME]
-        self.url = MODEL_METADATA[self.model_identifier][KEY_URL]
-        self.limit_fov = MODEL_METADATA[self.model_identifier][KEY_LIMIT_FOV]
+        model_metadata = get_model_metadata(self.model_identifier)
+        self.folder_name = model_metadata[KEY_FOLDER_NAME]
+        self.url = model_metadata[KEY_URL]
+        limit_fov = model_metadata[KEY_LIMIT_FOV]
+        # Models are pickled to herd workers, so they get their own copy of the read-only registry entry
+        self.limit_fov = dict(limit_fov) if limit_fov is not None else None
         self.directory = os.path.join(system.MODELS_DIRECTORY_PATH, self.folder_name)
 
         self.__download(output_manager)
         self.configuration_folders = self.__get_configuration_folders(output_manager)
         self.configuration_directory = os.path.join(self.directory, self.configuration_folders[0])
         self.trainer, self.planner, self.resolution_configuration = self.__get_model_configuration()
+        self.folds = self.__get_folds()
 
         self.dataset, self.plans = self.__get_model_data()
         self.voxel_spacing = tuple(self.plans.get('configurations').get(self.resolution_configuration).get('spacing', DEFAULT_SPACING))
-        self.imaging_type, self.modality, self.region = self.__get_model_identifier_segments()
-        self.multilabel_prefix = f"{self.imaging_type}_{self.modality}_{self.region}_"
+        self.imaging_type, self.modality, self.region = get_model_identifier_segments(self.model_identifier)
+        self.multilabel_prefix = get_multilabel_prefix(self.model_identifier)
+        self.expected_modalities, self.expected_prefixes = self.__get_expectation()
 
         self.organ_indices = self.__get_organ_indices()
         self.nr_training_data = self.__get_number_training_data()
 
-    def get_expectation(self):
+    def get_expectation(self) -> Tuple[List[str], List[str]]:
+        return self.expected_modalities, self.expected_prefixes
+
+    def __get_expectation(self) -> Tuple[List[str], List[str]]:
         if self.modality == 'FDG-PET-CT':
             expected_modalities = ['FDG-PET', 'CT']
         else:
@@ -182,18 +310,18 @@ class Model:
         trainer, planner, resolution_configuration = model_configuration_folder.split("__")
         return trainer, planner, resolution_configuration
 
-    def __get_model_identifier_segments(self) -> Tuple[str, str, str]:
-        segments = self.model_identifier.split('_')
+    def __get_folds(self) -> Tuple[str, ...]:
+        """
+        Determines the folds to predict with. A model trained on all data ("fold_all") is used on its own, otherwise
+        only the first available fold is used, so predictions never silently turn into a multi-fold ensemble.
+        """
+        folds = sorted(item[len("fold_"):] for item in os.listdir(self.configuration_directory)
+                       if item.startswith("fold_") and os.path.isdir(os.path.join(self.configuration_directory, item)))
 
-        imaging_type = segments[0]
-        if segments[1] == 'pt':
-            modality = f'{segments[1]}_{segments[2]}'.upper()
-            region = '_'.join(segments[3:])
-        else:
-            modality = segments[1].upper()
-            region = '_'.join(segments[2:])
+        if not folds or "all" in folds:
+            return ("all",)
 
-        return imaging_type, modality, region
+        return (folds[0],)
 
     def __get_model_data(self) -> Tuple[Dict, Dict]:
         dataset_json_path = os.path.join(self.configuration_directory, FILE_NAME_DATASET_JSON)
@@ -209,33 +337,34 @@ class Model:
 
         return dataset, plans
 
+    def __get_installed_url(self) -> Union[str, None]:
+        """
+        Returns the URL recorded in the model_version.json of the local model folder, None if there is none.
+        """
+        version_file_path = os.path.join(self.directory, "model_version.json")
+        try:
+            with open(version_file_path, 'r') as vf:
+                return json.load(vf).get("url")
+        except Exception:
+            return None  # Missing or corrupted, we'll just treat it as mismatch
+
     def __download(self, output_manager: system.OutputManager):
         """
         Download and extract the model if it does not exist locally
         or if the existing folder has a different URL recorded.
+
+        The model cache can be shared between processes and machines, so the archive is downloaded to a unique
+        temporary file and extracted into a temporary folder. The finished folder, with its model_version.json, is
+        then renamed into place in one step, and a folder that another process installed first is kept.
         """
 
-        # If folder already exists, check if we should remove it
+        # If folder already exists, check if we should replace it
         if os.path.exists(self.directory):
-            # Attempt to load the previously saved URL from version file
-            version_file_path = os.path.join(self.directory, "model_version.json")
-            old_url = None
-
-            if os.path.exists(version_file_path):
-                try:
-                    with open(version_file_path, 'r') as vf:
-                        version_data = json.load(vf)
-                        old_url = version_data.get("url")
-                except Exception:
-                    pass  # If JSON is corrupted, we'll just treat it as mismatch
-
-            # If the existing folder's URL doesn't match the new URL, remove folder
-            if old_url != self.url:
+            if self.__get_installed_url() != self.url:
                 output_manager.console_update(
                     f" Model version mismatch detected for '{self.model_identifier}'. Removing outdated model and downloading the latest model..."
 
                 )
-                shutil.rmtree(self.directory, ignore_errors=True)
             else:
                 # If the URL matches, we skip re-downloading
                 output_manager.log_update(
@@ -246,66 +375,92 @@ class Model:
                 )
                 return
 
-        # If folder doesn't exist or has been removed, proceed to download
-        if not os.path.exists(system.MODELS_DIRECTORY_PATH):
-            os.makedirs(system.MODELS_DIRECTORY_PATH)
+        # If folder doesn't exist or is outdated, proceed to download
+        os.makedirs(system.MODELS_DIRECTORY_PATH, exist_ok=True)
 
         if not self.url:
             raise ValueError(f" No URL specified for model '{self.model_identifier}'.")
 
-        output_manager.log_update(f"    - Downloading {self.model_identifier}")
-        download_file_name = os.path.basename(self.url)
-        download_file_path = os.path.join(system.MODELS_DIRECTORY_PATH, download_file_name)
-
-        response = requests.get(self.url, stream=True)
-        if response.status_code != 200:
-            output_manager.log_update(f"    X Failed to download model from {self.url}")
-            raise Exception(f" Failed to download model from {self.url}")
-
-        total_size = int(response.headers.get("Content-Length", 0))
-        chunk_size = 1024 * 10
-
-        progress = output_manager.create_file_progress_bar()
-        with progress:
-            task = progress.add_task(f"[white] Downloading {self.model_identifier}...", total=total_size)
-            with open(download_file_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    if chunk:
-                        f.write(chunk)
-                        progress.update(task, advance=chunk_size)
-
-        output_manager.log_update(
-            f"    - {self.model_identifier} ({self.folder_name}) downloaded."
-        )
+        # Imported here, as it is only needed when a model has to be downloaded
+        import requests
 
-        # Extract
-        progress = output_manager.create_file_progress_bar()
-        with progress:
-            with zipfile.ZipFile(download_file_path, 'r') as zip_ref:
-                total_size = sum(file.file_size for file in zip_ref.infolist())
-                task = progress.add_task(f"[white] Extracting {self.model_identifier}...", total=total_size)
-                for file in zip_ref.infolist():
-                    zip_ref.extract(file, system.MODELS_DIRECTORY_PATH)
-                    progress.update(task, advance=file.file_size)
-
-        output_manager.log_update(f"    - {self.model_identifier} extracted.")
-        os.remove(download_file_path)
-
-        # Save a small version file with the URL
-        os.makedirs(self.directory, exist_ok=True)
-        version_file_path = os.path.join(self.directory, "model_version.json")
-        with open(version_file_path, 'w') as vf:
-            json.dump({"url": self.url}, vf)
+        output_manager.log_update(f"    - Downloading {self.model_identifier}")
+        file_descriptor, download_file_path = tempfile.mkstemp(prefix=f".{self.folder_name}_", suffix=".zip",
+                                                               dir=system.MODELS_DIRECTORY_PATH)
+        os.close(file_descriptor)
+        extraction_directory = tempfile.mkdtemp(prefix=f".{self.folder_name}_", dir=system.MODELS_DIRECTORY_PATH)
+        try:
+            response = requests.get(self.url, stream=True)
+            if response.status_code != 200:
+                output_manager.log_update(f"    X Failed to download model from {self.url}")
+                raise Exception(f" Failed to download model from {self.url}")
+
+            total_size = int(response.headers.get("Content-Length", 0))
+
+            progress = output_manager.create_file_progress_bar()
+            with progress:
+                task = progress.add_task(f"[white] Downloading {self.model_identifier}...", total=total_size)
+                with open(download_file_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if chunk:
+                            f.write(chunk)
+                            progress.update(task, advance=len(chunk))
+
+            output_manager.log_update(
+                f"    - {self.model_identifier} ({self.folder_name}) downloaded."
+            )
+
+            # Extract
+            progress = output_manager.create_file_progress_bar()
+            with progress:
+                with zipfile.ZipFile(download_file_path, 'r') as zip_ref:
+                    total_size = sum(file.file_size for file in zip_ref.infolist())
+                    task = progress.add_task(f"[white] Extracting {self.model_identifier}...", total=total_size)
+                    for file in zip_ref.infolist():
+                        zip_ref.extract(file, extraction_directory)
+                        progress.update(task, advance=file.file_size)
+
+            output_manager.log_update(f"    - {self.model_identifier} extracted.")
+
+            # Save a small version file with the URL, last, so only a complete folder is ever marked as installed
+            extracted_model_directory = os.path.join(extraction_directory, self.folder_name)
+            os.makedirs(extracted_model_directory, exist_ok=True)
+            with open(os.path.join(extracted_model_directory, "model_version.json"), 'w') as vf:
+                json.dump({"url": self.url}, vf)
+
+            self.__install(extracted_model_directory, extraction_directory)
+        finally:
+            if os.path.exists(download_file_path):
+                os.remove(download_file_path)
+            shutil.rmtree(extraction_directory, ignore_errors=True)
 
         output_manager.log_update(f"    - {self.model_identifier} - setup complete.")
         output_manager.console_update(
             f"{ANSI_GREEN} {self.model_identifier} - setup complete. {ANSI_RESET}"
         )
 
+    def __install(self, extracted_model_directory: str, extraction_directory: str):
+        """
+        Renames the extracted model folder into place. An outdated folder is first renamed aside, so processes that
+        still read from it are not left with a half deleted folder, and it is removed together with the extraction
+        folder afterwards. If another process installed the same version in the meantime, its folder is kept.
+        """
+        if os.path.exists(self.directory) and self.__get_installed_url() != self.url:
+            try:
+                os.rename(self.directory, os.path.join(extraction_directory, "outdated"))
+            except OSError:
+                pass  # Another process moved it aside first
+
+        try:
+            os.rename(extracted_model_directory, self.directory)
+        except OSError:
+            if self.__get_installed_url() != self.url:
+                raise
 
     def __get_organ_indices(self) -> Dict[int, str]:
         labels = self.dataset.get('labels', {})
-        return {int(value): key for key, value in labels.items() if value != "0"}
+        # Organ names are read from dataset.json and compared against statistics keys, so share a single interned copy
+        return {int(value): sys.intern(key) for key, value in labels.items() if value != "0"}
 
     def __get_number_training_data(self) -> str:
         nr_training_data = str(self.dataset.get('numTraining', "Not Available"))
@@ -324,6 +479,7 @@ class Model:
             f" Trainer: {self.trainer}",
             f" Planner: {self.planner}",
             f" Resolution Configuration: {self.resolution_configuration}",
+            f" Folds: {', '.join(self.folds)}",
             f" Voxel Spacing: {self.voxel_spacing}",
             f" Imaging Type: {self.imaging_type}",
             f" Modality: {self.modality}",
@@ -343,37 +499,22 @@ class Model:
 
         return "\n".join(result)
 
-    @staticmethod
-    def model_identifier_valid(model_identifier: str, output_manager: system.OutputManager) -> bool:
-        if model_identifier not in MODEL_METADATA:
-            output_manager.console_update("No valid model selected.")
-            return False
-
-        model_information = MODEL_METADATA[model_identifier]
-        if KEY_URL not in model_information or KEY_FOLDER_NAME not in model_information or KEY_LIMIT_FOV not in model_information:
-            output_manager.console_update("One or more of the required keys url, folder_name, limit_fov are missing.")
-            return False
-
-        if model_information[KEY_URL] == "" or model_information[KEY_FOLDER_NAME] == "" or (model_information[KEY_LIMIT_FOV] is not None and not isinstance(model_information[KEY_LIMIT_FOV], dict)):
-            output_manager.console_update("One or more of the required keys url, folder_name, limit_fov are not defined correctly.")
-            return False
-
-        return True
-
 
 class ModelWorkflow:
-    def __init__(self, model_identifier: str, output_manager: system.OutputManager):
+    def __init__(self, model_identifier: str, output_manager: system.OutputManager,
+                 model_cache: Union[Dict[str, Model], None] = None):
         self.workflow: List[Model] = []
-        self.__construct_workflow(model_identifier, output_manager)
+        self.__construct_workflow(model_identifier, output_manager, {} if model_cache is None else model_cache)
         if self.workflow:
             self.initial_desired_spacing = self.workflow[0].voxel_spacing
             self.target_model = self.workflow[-1]
 
-    def __construct_workflow(self, model_identifier: str, output_manager: system.OutputManager):
-        model = Model(model_identifier, output_manager)
-        if model.limit_fov and isinstance(model.limit_fov, dict) and 'model_to_crop_from' in model.limit_fov:
-            self.__construct_workflow(model.limit_fov["model_to_crop_from"], output_manager)
-        self.workflow.append(model)
+    def __construct_workflow(self, model_identifier: str, output_manager: system.OutputManager, model_cache: Dict[str, Model]):
+        # The models to crop from come first, in the order resolved from MODEL_DEPENDENCIES
+        for required_model_identifier in get_required_models([model_identifier]):
+            if required_model_identifier not in model_cache:
+                model_cache[required_model_identifier] = Model(required_model_identifier, output_manager)
+            self.workflow.append(model_cache[required_model_identifier])
 
     def __len__(self) -> len:
         return len(self.workflow)
@@ -392,11 +533,23 @@ def construct_model_routine(model_identifiers: Union[str, List[str]], output_man
     if isinstance(model_identifiers, str):
         model_identifiers = [model_identifiers]
 
+    # Validate all identifiers against MODEL_METADATA first, so a typo fails before any model is downloaded
+    invalid_identifiers = []
+    for model_identifier in model_identifiers:
+        try:
+            get_model_metadata(model_identifier)
+        except ValueError:
+            invalid_identifiers.append(model_identifier)
+    if invalid_identifiers:
+        raise ValueError(f"Invalid model identifier(s): {', '.join(invalid_identifiers)}. "
+                         f"Available models: {', '.join(AVAILABLE_MODELS)}")
+
     model_routine: Dict = {}
+    model_cache: Dict[str, Model] = {}
     output_manager.log_update(' SETTING UP MODEL WORKFLOWS:')
     for model_identifier in model_identifiers:
         output_manager.log_update(' - Model name: ' + model_identifier)
-        model_workflow = ModelWorkflow(model_identifier, output_manager)
+        model_workflow = ModelWorkflow(model_identifier, output_manager, model_cache)
 
         if model_workflow.initial_desired_spacing in model_routine:
             model_routine[model_workflow.initial_desired_spacing].append(model_workflow)
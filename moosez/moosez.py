@@ -20,8 +20,10 @@ import os
 os.environ["nnUNet_raw"] = ""
 os.environ["nnUNet_preprocessed"] = ""
 os.environ["nnUNet_results"] = ""
+os.environ.setdefault("CUDA_MODULE_LOADING", "LAZY")
 
 import argparse
+import contextlib
 import time
 import SimpleITK
 import colorama
@@ -96,7 +98,29 @@ def main():
         nargs='?',
         const=2,
         type=int,
-        help='Specify the concurrent jobs (default: 2)'
+        help='Specify the concurrent jobs (default: 2). Switched on with one job per device on machines with '
+             'several GPUs. Herd jobs write no per-subject lines to the log and do not preload models or '
+             'prefetch subjects'
+    )
+
+    parser.add_argument(
+        '-mirror-off', '--mirroring_off',
+        action="store_false",
+        help='Deactivate test time mirroring (faster, but changes the results of models trained with mirroring)'
+    )
+
+    parser.add_argument(
+        '-compile', '--torch_compile',
+        action="store_true",
+        default=False,
+        help='Compile the networks with torch.compile (one-time compilation cost per model, faster inference)'
+    )
+
+    parser.add_argument(
+        '-no-prefetch', '--no_prefetch',
+        action="store_true",
+        default=False,
+        help='Do not load the next subject while the current one is predicted (lower peak memory for large images)'
     )
 
     parser.add_argument(
@@ -158,6 +182,10 @@ def main():
     model_names = args.model_names
     benchmark = args.benchmark
     moose_instances = args.moose_herd
+    prefetch_subjects = not args.no_prefetch and not benchmark
+    use_mirroring = args.mirroring_off
+    if args.torch_compile:
+        os.environ["nnUNet_compile"] = "True"
 
     output_manager.configure_logging(parent_folder)
     output_manager.log_update('----------------------------------------------------------------------------------------------------')
@@ -190,8 +218,18 @@ def main():
     modalities = input_validation.determine_model_expectations(model_routine, output_manager)
     output_manager.log_update(f'- Custom trainer: {custom_trainer_status}')
     accelerator, device_count = system.check_device(output_manager)
+    if moose_instances is None and device_count is not None and device_count > 1:
+        moose_instances = device_count
+        output_manager.console_update(f" Herd mode switched on automatically for the {device_count} devices. Per-subject "
+                                      f"details are not written to the log in herd mode.")
+        output_manager.log_update(f"- Herd mode switched on automatically with one job per device ({device_count}); "
+                                  f"herd jobs do not log per-subject details, preload models or prefetch subjects.")
+    preload_thread = None
     if moose_instances is not None:
         output_manager.console_update(f" Number of moose instances run in parallel: {moose_instances}")
+    elif not args.torch_compile:
+        # Preloading runs outside the nnUNet output redirect, so it is skipped when nnUNet announces torch.compile
+        preload_thread = predict.preload_predictors(model_routine, accelerator, output_manager, use_mirroring)
 
     # ----------------------------------
     # INPUT STANDARDIZATION
@@ -211,7 +249,8 @@ def main():
     # CHECKING FOR MOOSE COMPLIANT SUBJECTS
     # --------------------------------------
 
-    subjects = [os.path.join(parent_folder, d) for d in os.listdir(parent_folder) if os.path.isdir(os.path.join(parent_folder, d))]
+    with os.scandir(parent_folder) as entries:
+        subjects = [entry.path for entry in entries if entry.is_dir()]
     moose_compliant_subjects = input_validation.select_moose_compliant_subjects(subjects, modalities, output_manager)
 
     num_subjects = len(moose_compliant_subjects)
@@ -247,19 +286,37 @@ def main():
         output_manager.spinner_update(f'[{processed_subjects}/{num_subjects}] subjects processed.')
 
         if device_count is not None and device_count > 1:
-            accelerator_assignments = [f"{accelerator}:{i % device_count}" for i in range(len(subjects))]
+            accelerators = [f"{accelerator}:{i}" for i in range(min(device_count, moose_instances))]
         else:
-            accelerator_assignments = [accelerator] * len(subjects)
-
-        with concurrent.futures.ProcessPoolExecutor(max_workers=moose_instances, mp_context=mp_context) as executor:
-            futures = []
-            for i, (subject, accelerator) in enumerate(zip(moose_compliant_subjects, accelerator_assignments)):
-                futures.append(executor.submit(moose_subject, subject, i, num_subjects, model_routine,
-                                               accelerator, None, benchmark))
+            accelerators = [accelerator]
+
+        # One pool per device: every worker stays on a single device, so its cached predictors are loaded only once
+        with contextlib.ExitStack() as stack:
+            executors = []
+            for device_index in range(len(accelerators)):
+                device_workers = moose_instances // len(accelerators) + (device_index < moose_instances % len(accelerators))
+                executors.append(stack.enter_context(
+                    concurrent.futures.ProcessPoolExecutor(max_workers=device_workers, mp_context=mp_context)))
+
+            futures = {}
+            for i, subject in enumerate(moose_compliant_subjects):
+                # Deal the subjects per worker slot, so every device gets a share matching its number of workers
+                device_index = (i % moose_instances) % len(accelerators)
+                future = executors[device_index].submit(moose_subject, subject, i, num_subjects, model_routine,
+                                                        accelerators[device_index], None, benchmark, None, use_mirroring)
+                futures[future] = subject
 
             for future in concurrent.futures.as_completed(futures):
-                if benchmark:
-                    subject_performance_parameters.append(future.result())
+                subject_name = os.path.basename(futures[future])
+                try:
+                    subject_performance = future.result()
+                except Exception as exception:
+                    output_manager.spinner_warn(f'{constants.ANSI_RED} {subject_name} failed: {exception}{constants.ANSI_RESET}')
+                    output_manager.log_error(f" Processing {subject_name} failed: {exception!r}", exc_info=exception)
+                    output_manager.spinner_start(' Continuing')
+                else:
+                    if benchmark:
+                        subject_performance_parameters.append(subject_performance)
                 processed_subjects += 1
                 output_manager.spinner_update(f'[{processed_subjects}/{num_subjects}] subjects processed.')
 
@@ -269,11 +326,23 @@ def main():
             subject_performance_parameters.append(performance_observer.get_peak_resources())
 
     else:
-        for i, subject in enumerate(moose_compliant_subjects):
-            subject_performance = moose_subject(subject, i, num_subjects, model_routine,
-                                                accelerator, output_manager, benchmark)
-            if benchmark:
-                subject_performance_parameters.append(subject_performance)
+        if preload_thread is not None:
+            preload_thread.join()
+        # The next subject is loaded in the background while the current one is predicted, so two decoded images
+        # are held in memory at once. This is skipped with -no-prefetch and when benchmarking, so that the
+        # resources of every subject are measured on their own.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+            next_subject = None
+            for i, subject in enumerate(moose_compliant_subjects):
+                prepared_subject = next_subject.result() if next_subject is not None else None
+                next_subject = None
+                if prefetch_subjects and i + 1 < num_subjects:
+                    next_subject = prefetcher.submit(prepare_subject, moose_compliant_subjects[i + 1], output_manager)
+
+                subject_performance = moose_subject(subject, i, num_subjects, model_routine, accelerator,
+                                                    output_manager, benchmark, prepared_subject, use_mirroring)
+                if benchmark:
+                    subject_performance_parameters.append(subject_performance)
 
     end_total_time = time.time()
     total_elapsed_time = (end_total_time - start_total_time) / 60
@@ -302,7 +371,8 @@ def main():
 
 
 def moose(input_data: Union[str, Tuple[numpy.ndarray, Tuple[float, float, float]], SimpleITK.Image],
-          model_names: Union[str, List[str]], output_dir: str = None, accelerator: str = None) -> Tuple[Union[List[str], List[SimpleITK.Image], List[numpy.ndarray]], List[models.Model]]:
+          model_names: Union[str, List[str]], output_dir: str = None, accelerator: str = None,
+          use_mirroring: bool = constants.USE_MIRRORING) -> Tuple[Union[List[str], List[SimpleITK.Image], List[numpy.ndarray]], List[models.Model]]:
     """
     Execute the MOOSE 3.0 image segmentation process.
 
@@ -320,6 +390,9 @@ def moose(input_data: Union[str, Tuple[numpy.ndarray, Tuple[float, float, float]
     :param accelerator: Specifies the accelerator type, e.g., "cpu" or "cuda".
     :type accelerator: Optional[str]
 
+    :param use_mirroring: Whether to use test time mirroring, for the models that were trained with it.
+    :type use_mirroring: bool
+
     :return: The output type aligns with the input type:
              - str (file path): If `input_data` is a file path.
              - SimpleITK.Image: If `input_data` is a SimpleITK.Image.
@@ -365,9 +438,11 @@ def moose(input_data: Union[str, Tuple[numpy.ndarray, Tuple[float, float, float]
     used_models = []
     for desired_spacing, model_workflows in model_routine.items():
         resampled_array = image_processing.ImageResampler.resample_image_SimpleITK_DASK_array(image, 'bspline', desired_spacing)
+        initial_segmentations = {}
+        remaining_uses = predict.count_shared_initial_models(model_workflows)
 
         for model_workflow in model_workflows:
-            segmentation_array = predict.predict_from_array_by_iterator(resampled_array, model_workflow[0], accelerator, output_manager)
+            segmentation_array = predict.predict_initial_segmentation(resampled_array, model_workflow, initial_segmentations, remaining_uses, accelerator, output_manager, use_mirroring)
 
             if len(model_workflow) == 2:
                 inference_fov_intensities = model_workflow[1].limit_fov["inference_fov_intensities"]
@@ -379,7 +454,7 @@ def moose(input_data: Union[str, Tuple[numpy.ndarray, Tuple[float, float, float]
                     continue
 
                 segmentation_array, desired_spacing = predict.cropped_fov_prediction_pipeline(
-                    image, segmentation_array, model_workflow, accelerator, output_manager)
+                    image, segmentation_array, model_workflow, accelerator, output_manager, use_mirroring)
 
             segmentation = SimpleITK.GetImageFromArray(segmentation_array)
             segmentation.SetSpacing(desired_spacing)
@@ -404,8 +479,31 @@ def moose(input_data: Union[str, Tuple[numpy.ndarray, Tuple[float, float, float]
     return generated_segmentations, used_models
 
 
+def prepare_subject(subject: str, output_manager: system.OutputManager) -> Tuple[SimpleITK.Image, str, str, Union[str, None]]:
+    """
+    Loads the standardized CT image of a subject. Nothing is written to the subject directory, so this can run ahead
+    for the next subject while the current one is predicted.
+
+    :param subject: The path to the subject directory.
+    :type subject: str
+    :param output_manager: The output manager for console and logging.
+    :type output_manager: system.OutputManager
+    :return: The standardized CT image, the prefix for writing it (empty if it was not changed), the CT file path and
+             the PET file path (None if there is no PET image).
+    :rtype: tuple
+    """
+    subject_name = os.path.basename(subject)
+    file_path = file_utilities.get_files(subject, 'CT_', ('.nii', '.nii.gz'))[0]
+    output_manager.log_update(f" Loading {os.path.basename(file_path)} of subject {subject_name}")
+    image, standardization_prefix = image_processing.standardize_image(file_path, output_manager, subject_name)
+    pet_file = file_utilities.find_pet_file(subject)
+
+    return image, standardization_prefix, file_path, pet_file
+
+
 def moose_subject(subject: str, subject_index: int, number_of_subjects: int, model_routine: Dict, accelerator: str,
-                  output_manager: Union[system.OutputManager, None], benchmark: bool = False):
+                  output_manager: Union[system.OutputManager, None], benchmark: bool = False,
+                  prepared_subject: Union[Tuple, None] = None, use_mirroring: bool = constants.USE_MIRRORING):
     # SETTING UP DIRECTORY STRUCTURE
     subject_name = os.path.basename(subject)
 
@@ -425,33 +523,37 @@ def moose_subject(subject: str, subject_index: int, number_of_subjects: int, mod
     if benchmark:
         performance_observer.on()
 
+    start_time = time.time()
     output_manager.spinner_update(f'[{subject_index + 1}/{number_of_subjects}] Setting up directory structure for {subject_name}...')
     output_manager.log_update(' ')
     output_manager.log_update(f' SETTING UP MOOSE-Z DIRECTORY:')
     output_manager.log_update(' ')
+
     moose_dir, segmentations_dir, stats_dir = file_utilities.moose_folder_structure(subject)
     output_manager.log_update(f" MOOSE directory for subject {subject_name} at: {moose_dir}")
 
-    # RUN PREDICTION
-    start_time = time.time()
-    output_manager.log_update(' ')
-    output_manager.log_update(' RUNNING PREDICTION:')
-    output_manager.log_update(' ')
-
     performance_observer.record_phase("Loading Image")
-    file_path = file_utilities.get_files(subject, 'CT_', ('.nii', '.nii.gz'))[0]
-    image = image_processing.standardize_image(file_path, output_manager, moose_dir)
+    if prepared_subject is None:
+        prepared_subject = prepare_subject(subject, output_manager)
+    image, standardization_prefix, file_path, pet_file = prepared_subject
+    image_processing.write_standardized_image(image, file_path, standardization_prefix, moose_dir, output_manager)
     file_name = file_utilities.get_nifti_file_stem(file_path)
-    pet_file = file_utilities.find_pet_file(subject)
     performance_observer.metadata_image_size = image.GetSize()
     performance_observer.time_phase()
 
+    # RUN PREDICTION
+    output_manager.log_update(' ')
+    output_manager.log_update(' RUNNING PREDICTION:')
+    output_manager.log_update(' ')
+
     for desired_spacing, model_workflows in model_routine.items():
         performance_observer.record_phase(f"Resampling Image: {'x'.join(map(str,desired_spacing))}")
         resampling_time_start = time.time()
         resampled_array = image_processing.ImageResampler.resample_image_SimpleITK_DASK_array(image, 'bspline', desired_spacing)
         output_manager.log_update(f' - Resampling at {"x".join(map(str,desired_spacing))} took: {round((time.time() - resampling_time_start), 2)}s')
         performance_observer.time_phase()
+        initial_segmentations = {}
+        remaining_uses = predict.count_shared_initial_models(model_workflows)
 
         for model_workflow in model_workflows:
             performance_observer.record_phase(f"Predicting: {model_workflow.target_model}")
@@ -461,7 +563,7 @@ def moose_subject(subject: str, subject_index: int, number_of_subjects: int, mod
             model_time_start = time.time()
             output_manager.spinner_update(f'[{subject_index + 1}/{number_of_subjects}] Running prediction for {subject_name} using {model_workflow[0]}...')
             output_manager.log_update(f'   - Model {model_workflow.target_model}')
-            segmentation_array = predict.predict_from_array_by_iterator(resampled_array, model_workflow[0], accelerator, output_manager)
+            segmentation_array = predict.predict_initial_segmentation(resampled_array, model_workflow, initial_segmentations, remaining_uses, accelerator, output_manager, use_mirroring)
 
             if len(model_workflow) == 2:
                 inference_fov_intensities = model_workflow[1].limit_fov["inference_fov_intensities"]
@@ -475,7 +577,7 @@ def moose_subject(subject: str, subject_index: int, number_of_subjects: int, mod
                     performance_observer.time_phase()
                     continue
 
-                segmentation_array, desired_spacing = predict.cropped_fov_prediction_pipeline(image, segmentation_array, model_workflow, accelerator, output_manager)
+                segmentation_array, desired_spacing = predict.cropped_fov_prediction_pipeline(image, segmentation_array, model_workflow, accelerator, output_manager, use_mirroring)
 
             segmentation = SimpleITK.GetImageFromArray(segmentation_array)
             segmentation.SetSpacing(desired_spacing)
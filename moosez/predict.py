@@ -17,30 +17,97 @@
 # ----------------------------------------------------------------------------------------------------------------------
 
 import dask
+import functools
+import threading
 import torch
 import numpy as np
 import SimpleITK
 from typing import Tuple, List, Dict, Iterator
 from moosez import models
 from moosez import image_processing
+from moosez.constants import TILE_STEP_SIZE, USE_MIRRORING
 from moosez import system
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
 
 
-def initialize_predictor(model: models.Model, accelerator: str) -> nnUNetPredictor:
+def initialize_predictor(model: models.Model, accelerator: str, tile_step_size: float = TILE_STEP_SIZE,
+                         use_mirroring: bool = USE_MIRRORING) -> nnUNetPredictor:
     """
     Initializes the model for prediction.
+    Predictors are cached per process, so the weights of a model are only loaded once per accelerator.
 
     :param model: The model object.
     :type model: Model
     :param accelerator: The accelerator for prediction.
     :type accelerator: str
+    :param tile_step_size: The sliding window step size relative to the patch size. Larger values mean fewer patches.
+    :type tile_step_size: float
+    :param use_mirroring: Whether to use test time mirroring, which multiplies the number of forward passes.
+    :type use_mirroring: bool
+    :return: The initialized predictor object.
+    :rtype: nnUNetPredictor
+    """
+    return load_predictor(model.configuration_directory, accelerator, model.folds, tile_step_size, use_mirroring)
+
+
+def preload_predictors(model_routine: Dict[Tuple, List[models.ModelWorkflow]], accelerator: str,
+                       output_manager: system.OutputManager, use_mirroring: bool = USE_MIRRORING) -> threading.Thread:
+    """
+    Loads the predictors of every model in the routine in a background thread, so that reading the weights and
+    initializing the accelerator overlap with the input standardization. Join the returned thread before predicting,
+    otherwise a predictor that is still loading would be loaded a second time. Failures are logged, the predictor is
+    then loaded on first use as before.
+
+    :param model_routine: The model routine.
+    :type model_routine: Dict[Tuple, List[models.ModelWorkflow]]
+    :param accelerator: The accelerator for prediction.
+    :type accelerator: str
+    :param output_manager: The output manager for console and logging.
+    :type output_manager: system.OutputManager
+    :param use_mirroring: Whether to use test time mirroring, where the model allows it.
+    :type use_mirroring: bool
+    :return: The started preloading thread.
+    :rtype: threading.Thread
+    """
+    routine_models = {model.model_identifier: model for model_workflows in model_routine.values()
+                      for model_workflow in model_workflows for model in model_workflow}
+
+    def load_predictors():
+        for model in routine_models.values():
+            try:
+                initialize_predictor(model, accelerator, use_mirroring=use_mirroring)
+            except Exception as exception:
+                output_manager.log_update(f" Preloading the predictor of {model} failed, it is loaded on first use: {exception!r}")
+
+    preload_thread = threading.Thread(target=load_predictors, daemon=True)
+    preload_thread.start()
+    return preload_thread
+
+
+@functools.lru_cache(maxsize=None)
+def load_predictor(configuration_directory: str, accelerator: str, folds: Tuple[str, ...] = ("all",),
+                   tile_step_size: float = TILE_STEP_SIZE, use_mirroring: bool = USE_MIRRORING) -> nnUNetPredictor:
+    """
+    Loads the trained model from the configuration directory onto the accelerator.
+
+    :param configuration_directory: The nnUNet configuration directory of the model.
+    :type configuration_directory: str
+    :param accelerator: The accelerator for prediction.
+    :type accelerator: str
+    :param folds: The folds to load. Every additional fold adds one full prediction pass.
+    :type folds: tuple
+    :param tile_step_size: The sliding window step size relative to the patch size.
+    :type tile_step_size: float
+    :param use_mirroring: Whether to use test time mirroring.
+    :type use_mirroring: bool
     :return: The initialized predictor object.
     :rtype: nnUNetPredictor
     """
     device = torch.device(accelerator)
-    predictor = nnUNetPredictor(allow_tqdm=False, device=device)
-    predictor.initialize_from_trained_model_folder(model.configuration_directory, use_folds=("all",))
+    # nnUNet only keeps the whole prediction on the device for CUDA and warns about it on every other device
+    predictor = nnUNetPredictor(tile_step_size=tile_step_size, use_mirroring=use_mirroring, allow_tqdm=False,
+                                device=device, perform_everything_on_device=(device.type == 'cuda'))
+    predictor.initialize_from_trained_model_folder(configuration_directory, use_folds=folds)
     return predictor
 
 
@@ -54,7 +121,8 @@ def process_case(preprocessor, chunk: np.ndarray, chunk_properties: Dict, predic
                                           predictor.dataset_json)
 
     data_tensor = torch.from_numpy(data).contiguous()
-    if predictor.device == "cuda":
+    # predictor.device is a torch.device (e.g. cuda:0), which never compares equal to the plain string "cuda"
+    if predictor.device.type == "cuda":
         data_tensor = data_tensor.pin_memory()
 
     return {'data': data_tensor, 'data_properties': chunk_properties, 'ofile': None, 'location': location}
@@ -83,11 +151,12 @@ def preprocessing_iterator_from_array(image_array: np.ndarray, image_properties:
     return iterator, locations
 
 
-def predict_from_array_by_iterator(image_array: np.ndarray, model: models.Model, accelerator: str, output_manager: system.OutputManager):
+def predict_from_array_by_iterator(image_array: np.ndarray, model: models.Model, accelerator: str, output_manager: system.OutputManager,
+                                   use_mirroring: bool = USE_MIRRORING):
     image_array = image_array[None, ...]
 
     with output_manager.manage_nnUNet_output():
-        predictor = initialize_predictor(model, accelerator)
+        predictor = initialize_predictor(model, accelerator, use_mirroring=use_mirroring)
         image_properties = {
             'spacing': model.voxel_spacing
         }
@@ -102,7 +171,65 @@ def predict_from_array_by_iterator(image_array: np.ndarray, model: models.Model,
     return np.squeeze(combined_segmentations)
 
 
-def cropped_fov_prediction_pipeline(image, segmentation_array, workflow: models.ModelWorkflow, accelerator, output_manager: system.OutputManager):
+def count_shared_initial_models(model_workflows: List[models.ModelWorkflow]) -> Dict[str, int]:
+    """
+    Counts the models that start more than one workflow of a spacing group, e.g. a model that is requested on its own
+    and is also cropped from. Only their predictions are worth keeping for reuse.
+
+    :param model_workflows: The model workflows of one spacing group.
+    :type model_workflows: List[models.ModelWorkflow]
+    :return: The number of workflows that start with each shared model, keyed by model identifier.
+    :rtype: Dict[str, int]
+    """
+    uses: Dict[str, int] = {}
+    for model_workflow in model_workflows:
+        uses[model_workflow[0].model_identifier] = uses.get(model_workflow[0].model_identifier, 0) + 1
+    return {model_identifier: count for model_identifier, count in uses.items() if count > 1}
+
+
+def predict_initial_segmentation(image_array: np.ndarray, workflow: models.ModelWorkflow, initial_segmentations: Dict[str, np.ndarray],
+                                 remaining_uses: Dict[str, int], accelerator: str, output_manager: system.OutputManager,
+                                 use_mirroring: bool = USE_MIRRORING) -> np.ndarray:
+    """
+    Predicts the first model of a workflow, reusing an earlier prediction of the same model on the same image.
+
+    A model that other models crop from is often requested on its own as well, so it is only run once per subject.
+    Only the predictions of shared models are kept, and each is dropped after its last use, so in general a single
+    label volume is held at a time.
+
+    :param image_array: The resampled image array.
+    :type image_array: np.ndarray
+    :param workflow: The model workflow.
+    :type workflow: models.ModelWorkflow
+    :param initial_segmentations: The kept predictions on this image array, keyed by model identifier.
+    :type initial_segmentations: Dict[str, np.ndarray]
+    :param remaining_uses: The remaining uses of the shared models, see count_shared_initial_models. Updated in place.
+    :type remaining_uses: Dict[str, int]
+    :param accelerator: The accelerator used for prediction.
+    :type accelerator: str
+    :param output_manager: The output manager for console and logging.
+    :type output_manager: system.OutputManager
+    :param use_mirroring: Whether to use test time mirroring, where the model allows it.
+    :type use_mirroring: bool
+    :return: The segmentation array of the first model of the workflow.
+    :rtype: np.ndarray
+    """
+    initial_model = workflow[0]
+    segmentation_array = initial_segmentations.pop(initial_model.model_identifier, None)
+    if segmentation_array is None:
+        segmentation_array = predict_from_array_by_iterator(image_array, initial_model, accelerator, output_manager, use_mirroring)
+    else:
+        output_manager.log_update(f"     - Reusing the prediction of {initial_model}")
+
+    if initial_model.model_identifier in remaining_uses:
+        remaining_uses[initial_model.model_identifier] -= 1
+        if remaining_uses[initial_model.model_identifier] > 0:
+            initial_segmentations[initial_model.model_identifier] = segmentation_array
+    return segmentation_array
+
+
+def cropped_fov_prediction_pipeline(image, segmentation_array, workflow: models.ModelWorkflow, accelerator, output_manager: system.OutputManager,
+                                    use_mirroring: bool = USE_MIRRORING):
     """
     Process segmentation by resampling, limiting FOV, and predicting.
 
@@ -112,6 +239,7 @@ def cropped_fov_prediction_pipeline(image, segmentation_array, workflow: models.
         workflow (models.ModelWorkflow): List of routines where the second element contains model info.
         accelerator (any): The accelerator used for prediction.
         output_manager (output_manager: system.OutputManager): for console and logging.
+        use_mirroring (bool): Whether to use test time mirroring, where the model allows it.
 
     Returns:
         model (str): The model name used in the process.
@@ -152,7 +280,7 @@ def cropped_fov_prediction_pipeline(image, segmentation_array, workflow: models.
 
     # Predict the limited FOV segmentation
     limited_fov_segmentation_array = predict_from_array_by_iterator(limited_fov_image_array, target_model,
-                                                                            accelerator, output_manager)
+                                                                            accelerator, output_manager, use_mirroring)
 
     # Expand the segmentation to the original FOV
     expanded_segmentation_array = image_processing.expand_segmentation_fov(limited_fov_segmentation_array, original_fov_info)
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import logging
-import torch
+import logging.handlers
+import functools
 import os
 import sys
 import emoji
@@ -14,7 +15,7 @@ from rich.console import Console, RenderableType
 from rich.table import Table
 from rich.text import Text
 from rich.progress import Progress, TextColumn, BarColumn, FileSizeColumn, TransferSpeedColumn, TimeRemainingColumn
-from typing import Union, Tuple, List
+from typing import Union, Tuple, List, NamedTuple
 from moosez.constants import VERSION, ANSI_VIOLET, ANSI_RESET
 
 
@@ -95,21 +96,30 @@ class OutputManager:
         self.logger.setLevel(logging.INFO)
         self.logger.propagate = False
 
-        if not any(isinstance(handler, logging.FileHandler) for handler in self.logger.handlers):
+        if not any(isinstance(handler, (logging.FileHandler, logging.handlers.MemoryHandler)) for handler in self.logger.handlers):
             log_format = '%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s'
             formatter = logging.Formatter(log_format)
 
             log_filename = os.path.join(log_file_directory, f'moosez-v{VERSION}_{timestamp}.log')
-            file_handler = logging.FileHandler(log_filename, mode='w')
+            file_handler = logging.FileHandler(log_filename, mode='w', delay=True)
             file_handler.setLevel(logging.INFO)
             file_handler.setFormatter(formatter)
 
-            self.logger.addHandler(file_handler)
+            # Buffer records and write them in batches; errors and interpreter shutdown flush the buffer
+            memory_handler = logging.handlers.MemoryHandler(capacity=1024, flushLevel=logging.ERROR, target=file_handler)
+            memory_handler.setLevel(logging.INFO)
+
+            self.logger.addHandler(memory_handler)
 
     def log_update(self, text: str):
         if self.verbose_log and self.logger:
             self.logger.info(text)
 
+    def log_error(self, text: str, exc_info: Union[BaseException, None] = None):
+        # Errors flush the buffered log records, so they reach the log file even if the process dies right after
+        if self.verbose_log and self.logger:
+            self.logger.error(text, exc_info=exc_info)
+
     def console_update(self, text: Union[str, RenderableType]):
         if isinstance(text, str):
             text = Text.from_ansi(text)
@@ -188,28 +198,91 @@ class OutputManager:
         self.console_update(" Copyright 2022, Quantitative Imaging and Medical Physics Team, Medical University of Vienna")
 
 
-def check_device(output_manager: OutputManager = OutputManager(False, False)) -> Tuple[str, Union[int, None]]:
+# Accelerator backends in order of preference: device type, availability check and device count (None if the
+# backend has no device indices). Each check receives the torch module.
+DEVICE_PROBES = (
+    ("cuda", lambda torch: torch.cuda.is_available(), lambda torch: torch.cuda.device_count()),
+    ("xpu", lambda torch: hasattr(torch, "xpu") and torch.xpu.is_available(), lambda torch: torch.xpu.device_count()),
+    # MPS only exists on macOS, so other platforms skip the backend query altogether
+    ("mps", lambda torch: sys.platform == "darwin" and torch.backends.mps.is_available(), lambda torch: None),
+)
+
+
+@functools.lru_cache(maxsize=1)
+def probe_device() -> Tuple[str, Union[int, None]]:
+    """
+    Probes the available device for running predictions once per process, trying the backends of DEVICE_PROBES in
+    order. Later calls return the cached result without querying the driver again.
+
+    :return: The device type, either "cpu", "cuda", "xpu", or "mps", and the number of CUDA or XPU devices (None
+             otherwise).
+    :rtype: Tuple[str, Union[int, None]]
     """
-    This function checks the available device for running predictions, considering CUDA and MPS (for Apple Silicon).
+    import torch
+
+    for device, is_available, device_count in DEVICE_PROBES:
+        if is_available(torch):
+            return device, device_count(torch)
+    return "cpu", None
+
+
+class DeviceInfo(NamedTuple):
+    type: str
+    count: Union[int, None]
+    capability: Union[Tuple[int, int], None]
+    total_memory: Union[int, None]
+
+
+@functools.lru_cache(maxsize=1)
+def get_device_info() -> DeviceInfo:
+    """
+    Returns the probed device together with the compute capability and total memory of its first CUDA device. The
+    device properties are queried only once per process.
+
+    :return: The device type, device count, compute capability and total memory in bytes (None if not a CUDA device).
+    :rtype: DeviceInfo
+    """
+    device, device_count = probe_device()
+    if device != "cuda":
+        return DeviceInfo(device, device_count, None, None)
+
+    import torch
+    properties = torch.cuda.get_device_properties(0)
+    return DeviceInfo(device, device_count, (properties.major, properties.minor), properties.total_memory)
+
+
+def check_device(output_manager: Union[OutputManager, None] = None) -> Tuple[str, Union[int, None]]:
+    """
+    This function checks the available device for running predictions, considering CUDA, Intel XPU and MPS (for Apple
+    Silicon). The device is reported on the console and in the log of the output manager. Without an output manager
+    it is only reported to the moosez logger, at INFO level.
 
     Returns:
-        str: The device to run predictions on, either "cpu", "cuda", or "mps".
+        str: The device to run predictions on, either "cpu", "cuda", "xpu", or "mps".
     """
-    # Check for CUDA
-    if torch.cuda.is_available():
-        device_count = torch.cuda.device_count()
-        output_manager.console_update(f" CUDA is available with {device_count} GPU(s). Predictions will be run on GPU.")
-        return "cuda", device_count
-    # Check for MPS (Apple Silicon) Here for the future but not compatible right now
-    elif torch.backends.mps.is_available():
-        output_manager.console_update(" Apple MPS backend is available. Predictions will be run on Apple Silicon GPU.")
-        return "mps", None
-    elif not torch.backends.mps.is_built():
-        output_manager.console_update(" MPS not available because the current PyTorch install was not built with MPS enabled.")
-        return "cpu", None
+    device, device_count = probe_device()
+
+    if device == "cuda":
+        message = f" CUDA is available with {device_count} GPU(s). Predictions will be run on GPU."
+    elif device == "xpu":
+        message = f" Intel XPU is available with {device_count} device(s). Predictions will be run on XPU."
+    elif device == "mps":
+        message = " Apple MPS backend is available. Predictions will be run on Apple Silicon GPU."
+    else:
+        message = " CUDA/MPS not available. Predictions will be run on CPU."
+
+    if output_manager is None:
+        logging.getLogger(f'moosez-v{VERSION}').info(message)
     else:
-        output_manager.console_update(" CUDA/MPS not available. Predictions will be run on CPU.")
-        return "cpu", None
+        output_manager.console_update(message)
+        output_manager.log_update(message)
+
+    if device == "cuda" and output_manager is not None:
+        device_info = get_device_info()
+        output_manager.log_update(f" GPU compute capability: {'.'.join(map(str, device_info.capability))}, "
+                                  f"memory: {round(device_info.total_memory / 1024 ** 3, 1)} GB")
+
+    return device, device_count
 
 
 def get_virtual_env_root() -> str:
@@ -225,4 +298,4 @@ def get_virtual_env_root() -> str:
 
 
 ENVIRONMENT_ROOT_PATH: str = get_virtual_env_root()
-MODELS_DIRECTORY_PATH: str = os.path.join(ENVIRONMENT_ROOT_PATH, 'models', 'nnunet_trained_models')
+MODELS_DIRECTORY_PATH: str = os.environ.get("MOOSEZ_MODEL_CACHE") or os.path.join(ENVIRONMENT_ROOT_PATH, 'models', 'nnunet_trained_models')